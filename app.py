@@ -1,12 +1,24 @@
+import asyncio
+import copy
+import functools
 import logging
 import gradio as gr
 from yt_dlp import YoutubeDL
+from yt_dlp.cookies import YoutubeDLCookieJar
+from yt_dlp.networking.impersonate import ImpersonateTarget
 import os
+import re
 from dotenv import load_dotenv
 from pathlib import Path
+import sys
+import threading
 import time
-from tqdm import tqdm
+from collections import OrderedDict
 import tempfile
+import shutil
+import io
+
+IO_BUFFER_SIZE = 1 << 20
 
 logging.basicConfig(
     level=logging.INFO,
@@ -22,14 +34,81 @@ BASE_DIR = Path(__file__).resolve().parent
 OUTPUT_DIR = BASE_DIR / "outputs"
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
+load_dotenv()
+USE_FIREFOX_COOKIES = os.getenv("USE_FIREFOX_COOKIES", "False") == "True"
+FIREFOX_COOKIES = os.getenv("FIREFOX_COOKIES", "")
+
+MAX_CONCURRENT_DOWNLOADS = 4
+MAX_DOWNLOADS_PER_USER = 1
+MAX_QUEUE_SIZE = 16
+DOWNLOAD_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+_active_downloads = {}
+
+MAX_IDLE_DOWNLOADERS = MAX_CONCURRENT_DOWNLOADS
+_ydl_pool = []
+_ydl_pool_lock = threading.Lock()
+
+INFO_CACHE_SIZE = 256
+INFO_CACHE_TTL = 300
+_info_cache = OrderedDict()
+_info_cache_lock = threading.Lock()
+
+DEFAULT_CONNECTIONS = 8
+MAX_CONNECTIONS = (os.cpu_count() or 1) * 4
+PROGRESS_INTERVAL = 0.1
+PROGRESS_MIN_BYTES = 1 << 20
+
+VIDEO_ID_RE = re.compile(r'(?:[?&]v=|youtu\.be/|shorts/)([\w-]{11})')
+
+VIDEO_FORMAT_SPECS = {
+    'mp4': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',
+    'webm': 'bestvideo[ext=webm]+bestaudio[ext=webm]/best[ext=webm]/best',
+}
+
+AUDIO_QUALITY = {
+    'high': '320',
+    'medium': '192',
+}
+
+STREAM_COPY_ARGS = ['-c:v', 'copy', '-c:a', 'copy']
+FRAGMENTED_MOOV_ARGS = ['-movflags', 'empty_moov+frag_keyframe+default_base_moof']
+LARGE_FILE_SIZE = 1 << 30
+
+AUDIO_COPY_FORMATS = {
+    'm4a': 'bestaudio[ext=m4a]/bestaudio/best',
+    'opus': 'bestaudio[acodec=opus]/bestaudio/best',
+}
+
+def _atomic_write(path: str, data: bytes) -> None:
+    """Write data to a sibling temp file and atomically replace path with it"""
+    # Replace the symlink target rather than the link, and keep its mode;
+    # new files keep NamedTemporaryFile's private 0600 mode.
+    path = os.path.realpath(path)
+    temp = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.tmp-', delete=False)
+    try:
+        with temp:
+            temp.write(data)
+            temp.flush()
+            if os.path.exists(path):
+                os.chmod(temp.name, os.stat(path).st_mode & 0o7777)
+            os.fsync(temp.fileno())
+        os.replace(temp.name, path)
+    except BaseException:
+        os.unlink(temp.name)
+        raise
+
 def cookies_to_env(cookie_file_path: str) -> str:
     """Convert cookie file content to environment variable format"""
     try:
-        with open(cookie_file_path, 'r') as f:
-            lines = f.readlines()
-            
-        header = [line.strip() for line in lines if line.startswith('#')]
-        cookies = [line.strip() for line in lines if line.strip() and not line.startswith('#')]
+        with open(cookie_file_path, 'r', buffering=IO_BUFFER_SIZE) as f:
+            data = f.read()
+
+        header, cookies = [], []
+        for line in data.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            (header if line[0] == '#' else cookies).append(line)
         
         content = '\\n'.join(header + [''] + cookies) 
         
@@ -48,25 +127,22 @@ def env_to_cookies(env_content: str, output_file: str) -> None:
         
         cookie_content = content.replace('\\n', '\n')
         
-        with open(output_file, 'w') as f:
-            f.write(cookie_content)
-            
+        _atomic_write(output_file, cookie_content.encode())
+
     except Exception as e:
         raise ValueError(f"Error converting to cookie file: {str(e)}")
 
 def save_to_env_file(env_content: str, env_file: str = '.env') -> None:
     """Save environment variable content to .env file"""
     try:
-        with open(env_file, 'w') as f:
-            f.write(env_content)
+        _atomic_write(env_file, env_content.encode())
     except Exception as e:
         raise ValueError(f"Error saving to env file: {str(e)}")
 
 def env_to_cookies_from_env(output_file: str) -> None:
     """Convert environment variable from .env file to cookie file"""
     try:
-        load_dotenv()
-        env_content = os.getenv('FIREFOX_COOKIES', "")
+        env_content = FIREFOX_COOKIES
         if not env_content:
             raise ValueError("FIREFOX_COOKIES not found in .env file")
             
@@ -76,15 +152,19 @@ def env_to_cookies_from_env(output_file: str) -> None:
 
 def get_cookies():
     """Get cookies from environment variable"""
-    load_dotenv()
-    cookie_content = os.getenv('FIREFOX_COOKIES', "")
+    cookie_content = FIREFOX_COOKIES
     if not cookie_content:
         raise ValueError("FIREFOX_COOKIES environment variable not set")
     return cookie_content
 
+def load_cookies(jar: YoutubeDLCookieJar) -> None:
+    """Load cookies from environment variable into an existing cookie jar"""
+    cookie_content = get_cookies().replace('\\n', '\n')
+    jar.load(io.StringIO(cookie_content), ignore_discard=True, ignore_expires=True)
+
 def create_temp_cookie_file():
     """Create temporary cookie file from environment variable"""
-    temp_cookie = tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix='.txt')
+    temp_cookie = tempfile.NamedTemporaryFile(mode='w+', buffering=IO_BUFFER_SIZE, delete=False, suffix='.txt')
     try:
         cookie_content = get_cookies()
         cookie_content = cookie_content.replace('\\n', '\n')
@@ -94,75 +174,263 @@ def create_temp_cookie_file():
     finally:
         temp_cookie.close()
 
-def download_for_browser(url, mode='audio', quality='high', audio_format='mp3', video_format='mp4'):
+@functools.lru_cache(maxsize=None)
+def get_impersonate_target():
+    """Get the Chrome impersonate target if an installed yt-dlp handler supports it"""
+    # _impersonate_target_available is not public yt-dlp API yet, so any
+    # failure just disables impersonation instead of breaking downloads.
+    try:
+        target = ImpersonateTarget.from_str('chrome')
+        with YoutubeDL({'quiet': True, 'no_warnings': True}) as probe:
+            return target if probe._impersonate_target_available(target) else None
+    except Exception as e:
+        logger.warning(f"Impersonation check failed, using default HTTP handler: {e}")
+        return None
+
+def acquire_downloader(key: tuple, opts: dict):
+    """Take an idle pooled YoutubeDL for key, building one from opts on a miss"""
+    with _ydl_pool_lock:
+        for i in range(len(_ydl_pool) - 1, -1, -1):
+            if _ydl_pool[i][0] == key:
+                return _ydl_pool.pop(i)[1]
+
+    # yt-dlp copies progress hooks at construction, so pooled instances get a
+    # fixed hook that forwards to whichever download currently owns them.
+    hook = [None]
+
+    def forward_progress(d):
+        if hook[0] is not None:
+            hook[0](d)
+
+    if not opts.get('noprogress'):
+        opts = {**opts, 'progress_hooks': [forward_progress]}
+    ydl = YoutubeDL(opts)
+    if USE_FIREFOX_COOKIES:
+        # The request handlers may already hold this jar (e.g. after the
+        # impersonate check in __init__), so fill it rather than replace it.
+        try:
+            load_cookies(ydl.cookiejar)
+        except Exception:
+            ydl.close()
+            raise
+    return ydl, hook
+
+def release_downloader(key: tuple, downloader) -> None:
+    """Return a YoutubeDL taken with acquire_downloader to the pool, closing the oldest idle ones over the cap"""
+    with _ydl_pool_lock:
+        _ydl_pool.append((key, downloader))
+        evicted = _ydl_pool[:-MAX_IDLE_DOWNLOADERS]
+        del _ydl_pool[:-MAX_IDLE_DOWNLOADERS]
+    for _, (ydl, hook) in evicted:
+        ydl.close()
+
+def get_cached_info(url: str):
+    """Get a copy of the unprocessed extractor result for url, if still fresh"""
+    with _info_cache_lock:
+        entry = _info_cache.get(url)
+        if entry is None:
+            return None
+        expires, info = entry
+        if expires < time.monotonic():
+            del _info_cache[url]
+            return None
+    # process_ie_result mutates the dict it is given
+    return copy.deepcopy(info)
+
+def cache_info(url: str, info: dict) -> None:
+    """Store an unprocessed extractor result for url, evicting the oldest entries"""
+    info = copy.deepcopy(info)
+    with _info_cache_lock:
+        _info_cache[url] = (time.monotonic() + INFO_CACHE_TTL, info)
+        _info_cache.move_to_end(url)
+        while len(_info_cache) > INFO_CACHE_SIZE:
+            _info_cache.popitem(last=False)
+
+def invalidate_info(url: str) -> None:
+    """Drop any cached extractor result for url"""
+    with _info_cache_lock:
+        _info_cache.pop(url, None)
+
+def estimate_mp4_download_size(info: dict) -> int:
+    """Estimate the size of the largest mp4 video plus m4a audio stream the mp4 format spec can pick"""
+    if info.get('filesize_approx'):
+        return info['filesize_approx']
+    best_video = best_audio = 0
+    for fmt in info.get('formats') or []:
+        size = fmt.get('filesize') or fmt.get('filesize_approx') or 0
+        if fmt.get('ext') == 'mp4' and fmt.get('vcodec') not in (None, 'none'):
+            best_video = max(best_video, size)
+        elif fmt.get('ext') == 'm4a' and fmt.get('acodec') not in (None, 'none'):
+            best_audio = max(best_audio, size)
+    return best_video + best_audio
+
+def video_postprocessor_args(video_format: str, info: dict):
+    """Get ffmpeg args for a video download, fragmenting the moov of large MP4 merges"""
+    # yt-dlp already writes MP4 output with +faststart, which costs a second
+    # pass over the file; large merges write a fragmented moov up front instead.
+    if video_format == 'mp4' and estimate_mp4_download_size(info) > LARGE_FILE_SIZE:
+        return {'default': STREAM_COPY_ARGS, 'merger+ffmpeg_o': STREAM_COPY_ARGS + FRAGMENTED_MOOV_ARGS}
+    return STREAM_COPY_ARGS
+
+def find_latest_output(prefix: str):
+    """Find the most recently modified output file whose name starts with prefix"""
+    with os.scandir(OUTPUT_DIR) as entries:
+        candidates = [entry for entry in entries if entry.name.startswith(prefix) and entry.is_file()]
+    latest = max(candidates, key=lambda entry: entry.stat().st_mtime, default=None)
+    return Path(latest.path) if latest is not None else None
+
+def get_video_id(url: str):
+    """Extract the YouTube video ID from a watch, youtu.be or shorts URL"""
+    match = VIDEO_ID_RE.search(url)
+    return match.group(1) if match else None
+
+async def download_for_browser(url, mode='audio', quality='high', audio_format='mp3', video_format='mp4', connections=DEFAULT_CONNECTIONS, request: gr.Request = None):
+    user = request.session_hash if request is not None else None
+    if DOWNLOAD_SEMAPHORE.locked():
+        return None, "Server busy - too many downloads in progress, please try again shortly"
+    if _active_downloads.get(user, 0) >= MAX_DOWNLOADS_PER_USER:
+        return None, "You already have a download in progress, please wait for it to finish"
+
+    _active_downloads[user] = _active_downloads.get(user, 0) + 1
+    try:
+        async with DOWNLOAD_SEMAPHORE:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, functools.partial(_do_download, url, mode, quality, audio_format, video_format, connections))
+    finally:
+        _active_downloads[user] -= 1
+        if not _active_downloads[user]:
+            del _active_downloads[user]
+
+def _do_download(url, mode='audio', quality='high', audio_format='mp3', video_format='mp4', connections=DEFAULT_CONNECTIONS):
     if not url:
         return None, "Please enter a valid URL"
-    logger.info(f"Downloading {url} in {mode} mode with {quality} quality, audio format {audio_format}, video format {video_format}")
+    connections = max(1, min(int(connections), MAX_CONNECTIONS))
+    logger.info(f"Downloading {url} in {mode} mode with {quality} quality, audio format {audio_format}, video format {video_format}, {connections} parallel fragment downloads")
 
     try:
-        pbar = tqdm(unit='B', unit_scale=True, unit_divisor=1024, miniters=1, desc=url.split("watch?v=")[-1] if "watch?v=" in url else "Download")
+        show_progress = sys.stderr.isatty()
+        pbar = [None]
+        last_update = [0.0]
+        last_bytes = [0]
 
         def progress_hook(d):
+            # A merge downloads several streams, each with its own byte count,
+            # so every stream gets a fresh bar and rate-limit state.
+            if pbar[0] is None:
+                pbar[0] = tqdm(unit='B', unit_scale=True, unit_divisor=1024, miniters=1, desc=get_video_id(url) or "Download")
+                last_update[0] = 0.0
+                last_bytes[0] = 0
+            bar = pbar[0]
             if d['status'] == 'downloading':
+                downloaded = d['downloaded_bytes']
+                now = time.monotonic()
+                if now - last_update[0] < PROGRESS_INTERVAL and downloaded - last_bytes[0] < PROGRESS_MIN_BYTES:
+                    return
+                last_update[0] = now
+                last_bytes[0] = downloaded
                 if 'total_bytes' in d:
-                    pbar.total = d['total_bytes']
-                pbar.update(d['downloaded_bytes'] - pbar.n)
+                    bar.total = d['total_bytes']
+                bar.update(downloaded - bar.n)
             if d['status'] == 'finished':
-                pbar.close()
+                bar.update(d.get('downloaded_bytes', bar.total or bar.n) - bar.n)
+                bar.close()
+                pbar[0] = None
             if d['status'] == 'error':
-                pbar.close()
+                bar.close()
+                pbar[0] = None
                 logger.error(f"Download error: {d['error']}")
 
         opts = {
             'format': 'bestaudio/best' if mode == 'audio' else 'bestvideo+bestaudio/best',
-            'outtmpl': str(OUTPUT_DIR / '%(title)s.%(ext)s'),
+            'outtmpl': '%(title)s.%(ext)s',
             'restrictfilenames': True,
-            'windowsfilenames': True,
+            'windowsfilenames': os.name == 'nt',
             'quiet': True,
             'no_warnings': True,
-            'progress_hooks': [progress_hook],
+            'concurrent_fragment_downloads': connections,
+            'retries': 10,
+            'fragment_retries': 10,
+            'buffersize': 1024 * 1024,
         }
+
+        impersonate_target = get_impersonate_target()
+        if impersonate_target is not None:
+            opts['impersonate'] = impersonate_target
+
+        if show_progress:
+            from tqdm import tqdm
+        else:
+            opts['noprogress'] = True
         
         if mode == 'audio':
+            # FFmpegExtractAudio stream-copies when the source codec already
+            # matches, so prefer a source stream that needs no re-encode.
             opts.update({
+                'format': AUDIO_COPY_FORMATS.get(audio_format, 'bestaudio/best'),
                 'postprocessors': [{
                     'key': 'FFmpegExtractAudio',
                     'preferredcodec': audio_format,
-                    'preferredquality': '320' if quality == 'high' else '192',
+                    'preferredquality': AUDIO_QUALITY.get(quality, '192'),
                 }],
                 'prefer_ffmpeg': True,
                 'keepvideo': False
             })
         else:
-            if video_format == 'mp4':
-                format_spec = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
-            elif video_format == 'webm':
-                format_spec = 'bestvideo[ext=webm]+bestaudio[ext=webm]/best[ext=webm]/best'
-            else:
-                format_spec = 'bestvideo+bestaudio/best'
-                
             opts.update({
-                'format': format_spec,
+                'format': VIDEO_FORMAT_SPECS.get(video_format, 'bestvideo+bestaudio/best'),
                 'merge_output_format': video_format,
-                'postprocessor_args': ['-c:v', 'copy', '-c:a', 'copy'],
+                'postprocessor_args': STREAM_COPY_ARGS,
                 'prefer_ffmpeg': True
             })
 
-        load_dotenv()
-        USE_FIREFOX_COOKIES = os.getenv("USE_FIREFOX_COOKIES", "False")
-        if USE_FIREFOX_COOKIES == "True":
-            cookiefile = "firefox-cookies.txt"
-            env_to_cookies_from_env("firefox-cookies.txt")
-
+        if USE_FIREFOX_COOKIES:
             logger.info(f"Using Firefox cookies: {USE_FIREFOX_COOKIES}")
-            opts["cookiefile"] = "firefox-cookies.txt"
         else:
             opts["no_cookies"] = True  
 
         logger.info(f"Downloading {url} with options: {opts}")
         start_time = time.time()
-        with YoutubeDL(opts) as ydl:
-            info = ydl.extract_info(url, download=True)
+        if mode == 'audio':
+            pool_key = (mode, quality, audio_format)
+        else:
+            pool_key = (mode, video_format)
+        ydl, hook = acquire_downloader(pool_key, opts)
+        # Fragment downloaders read this at download time, so it is set per
+        # download rather than splitting the pool by connection count.
+        ydl.params['concurrent_fragment_downloads'] = connections
+        hook[0] = progress_hook if show_progress else None
+        # Concurrent downloads of the same title would otherwise share one
+        # .part file; finished files are moved from here into OUTPUT_DIR.
+        temp_dir = tempfile.mkdtemp(prefix='.download-', dir=OUTPUT_DIR)
+        ydl.params['paths'] = {'home': str(OUTPUT_DIR), 'temp': temp_dir}
+        try:
+            info = get_cached_info(url)
+            if info is None:
+                info = ydl.extract_info(url, download=False, process=False)
+                # Playlist and tab results carry lazy generator entries
+                if info.get('_type', 'video') == 'video':
+                    cache_info(url, info)
+            if mode == 'video':
+                # Postprocessors read this at run time, and the instance is
+                # pooled, so it is set for every video download.
+                ydl.params['postprocessor_args'] = video_postprocessor_args(video_format, info)
+            info = ydl.process_ie_result(info, download=True, extra_info={'original_url': url})
+            filename = None
+            for requested in info.get('requested_downloads', []):
+                filename = requested.get('filepath') or requested.get('_filename')
+                if filename:
+                    break
+            if not filename:
+                filename = ydl.prepare_filename(info)
+        except Exception:
+            # Don't hand a possibly half-torn-down instance to the next request
+            ydl.close()
+            invalidate_info(url)
+            raise
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        hook[0] = None
+        release_downloader(pool_key, (ydl, hook))
 
         end_time = time.time()
         elapsed_time = end_time - start_time
@@ -170,17 +438,10 @@ def download_for_browser(url, mode='audio', quality='high', audio_format='mp3',
         logger.info(f"Download completed at: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end_time))}")
         logger.info(f"Download time: {elapsed_time:.2f} seconds")
 
-        files = list(OUTPUT_DIR.glob('*'))
-        if not files:
-            return None, "Download failed - no files found in output directory"
-
-        download_file = None
-        for file in files:
-            if file.name.startswith(info['title']):
-                if download_file is None or file.stat().st_mtime > download_file.stat().st_mtime:
-                    download_file = file
-
-        if download_file is None or not download_file.exists():
+        download_file = Path(filename)
+        if not download_file.exists():
+            download_file = find_latest_output(download_file.stem)
+        if download_file is None:
             return None, "File download in output directory failed"
 
         logger.info(f"Downloaded file: {download_file.name}")
@@ -270,6 +531,18 @@ def create_browser_ui():
                             elem_id="video_format_input",
                             container=True,
                         )
+
+                with gr.Row():
+                    connections_input = gr.Slider(
+                        minimum=1,
+                        maximum=MAX_CONNECTIONS,
+                        value=min(DEFAULT_CONNECTIONS, MAX_CONNECTIONS),
+                        step=1,
+                        label="Parallel Fragment Downloads",
+                        info="Applies to fragmented (DASH/HLS) streams only; regular downloads use one connection",
+                        elem_id="connections_input",
+                        container=True,
+                    )
                 
                 with gr.Row():
                     download_button = gr.Button(
@@ -321,14 +594,16 @@ def create_browser_ui():
 
         download_button.click(
             fn=download_for_browser,
-            inputs=[url_input, mode_input, quality_input, audio_format_input, video_format_input],
+            inputs=[url_input, mode_input, quality_input, audio_format_input, video_format_input, connections_input],
             outputs=[status_text]
         )
 
     return demo
 
 demo = create_browser_ui()
-demo.launch(
+# Handlers are cheap until they pass DOWNLOAD_SEMAPHORE, so Gradio starts them
+# without a limit and over-limit requests get a "Server busy" reply at once.
+demo.queue(default_concurrency_limit=None, max_size=MAX_QUEUE_SIZE).launch(
     share=False,
     debug=False,
     show_error=False